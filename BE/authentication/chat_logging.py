@@ -0,0 +1,90 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import re
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List
+
+from django.conf import settings
+
+REDACTIONS = [
+    (re.compile(r'sk-[A-Za-z0-9_\-]{8,}'), '[KEY]'),
+    (re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+'), '[EMAIL]'),
+    (re.compile(r'\b(?:\d[ -]?){13,19}\b'), '[CARD]'),
+    (re.compile(r'\+?\d[\d ().-]{7,}\d'), '[PHONE]'),
+]
+
+
+class QueueLogHandler(QueueHandler):
+    """
+    Hands records to a background thread that writes them to stderr.
+
+    Request threads only pay for a queue put; formatting and stream I/O happen on
+    the listener thread.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        super().__init__(queue.Queue(maxsize))
+        stream = logging.StreamHandler()
+        stream.setFormatter(StructuredFormatter())
+        self.listener = QueueListener(self.queue, stream, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Dropping a log line beats blocking a request behind a slow stream.
+            pass
+
+
+class StructuredFormatter(logging.Formatter):
+    """Plain log line followed by the record's `fields` extra as JSON."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line = f"{line} {json.dumps(fields, default=str)}"
+        return line
+
+
+def redact(text: str) -> str:
+    for pattern, replacement in REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def payload_sampled(logger: logging.Logger) -> bool:
+    """Whether to log a content payload for this request."""
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < settings.CHAT_LOG_SAMPLE_RATE
+
+
+def preview(text: str) -> str:
+    """Redacted, size-capped excerpt of user or model content."""
+    # Redact before cutting, or a key or card number straddling the cap would slip past the patterns
+    text = redact(text)
+    limit = settings.CHAT_LOG_MAX_CHARS
+    if len(text) > limit:
+        text = text[:limit] + f"...[{len(text) - limit} more chars]"
+    return text
+
+
+def summarize_messages(messages: List[Dict], include_content: bool = False) -> Dict:
+    """Shape of a message list for logs: counts and sizes, plus capped previews when sampled."""
+    summary = {
+        'count': len(messages),
+        'chars': sum(len(m.get('content', '')) for m in messages),
+    }
+    if include_content:
+        tail = messages[-settings.CHAT_LOG_MAX_MESSAGES:]
+        summary['tail'] = [
+            {'role': m.get('role'), 'content': preview(m.get('content', ''))} for m in tail
+        ]
+    return summary
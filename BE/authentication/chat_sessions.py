@@ -0,0 +1,118 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Conversation, Message
+from .retrieval import embed
+
+
+class SessionContext:
+    """Recent messages of one conversation, as dicts in id order."""
+
+    def __init__(self, conversation_id: int):
+        self.conversation_id = conversation_id
+        self.messages: List[Dict] = []
+        self.last_id = 0
+        self.lock = threading.Lock()
+
+    def refresh(self) -> None:
+        """Pull rows newer than the cached tail, e.g. ones written by another worker."""
+        query = Message.objects.filter(conversation_id=self.conversation_id, id__gt=self.last_id)
+        if not self.last_id:
+            # Cold start: only the tail is needed, older turns come from retrieval.
+            query = query.order_by('-id')[:settings.CHAT_SESSION_MAX_MESSAGES]
+        rows = sorted(query.values('id', 'role', 'content'), key=lambda row: row['id'])
+        self.extend(rows)
+
+    def extend(self, rows: List[Dict]) -> None:
+        if not rows:
+            return
+        self.messages.extend(rows)
+        del self.messages[:-settings.CHAT_SESSION_MAX_MESSAGES]
+        self.last_id = rows[-1]['id']
+
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+def get_session(conversation_id: int) -> SessionContext:
+    with _sessions_lock:
+        session = _sessions.pop(conversation_id, None)
+        if session is None:
+            session = SessionContext(conversation_id)
+        _sessions[conversation_id] = session
+        while len(_sessions) > settings.CHAT_SESSION_CACHE_SIZE:
+            _sessions.popitem(last=False)
+    return session
+
+
+def _store_turn(conversation: Conversation, content: str, ai_response: str) -> None:
+    # Embed up front so the retrieval index does not have to write them back later
+    Message.objects.bulk_create([
+        Message(conversation=conversation, role=role, content=text, embedding=embed(text).tobytes())
+        for role, text in (('user', content), ('assistant', ai_response))
+    ])
+
+
+def run_turn(conversation: Conversation, content: str, get_response) -> str:
+    """
+    Answer one new user message using the server-held context of a conversation.
+
+    get_response receives the context list and the conversation id and returns the
+    reply. Both turns are stored only if it succeeds, so a failed call leaves no
+    dangling user message behind.
+    """
+    session = get_session(conversation.id)
+    with session.lock:
+        session.refresh()
+        context = session.messages + [{'role': 'user', 'content': content}]
+        ai_response = get_response(context, conversation.id)
+        if ai_response.startswith('Error:'):
+            return ai_response
+
+        with transaction.atomic():
+            _store_turn(conversation, content, ai_response)
+            # Bump updated_at so list/history validators change
+            conversation.save(update_fields=['updated_at'])
+
+        # An indexed tail read also picks up rows other workers wrote meanwhile
+        session.refresh()
+        return ai_response
+
+
+def start_conversation(user, chatbot_type: str, title: str, content: str,
+                       get_response) -> Tuple[Optional[Conversation], str]:
+    """
+    First turn of a new session. Returns (conversation or None, reply).
+
+    The conversation row is created hidden before the call, so the first turn's usage
+    is attributed to it, and only becomes visible together with both messages once
+    the reply succeeds; a failed first turn deletes it again. The row is not created
+    inside a transaction because that would hold the write lock for the whole call.
+    """
+    conversation = Conversation.objects.create(
+        user=user,
+        title=title,
+        is_visible=False,
+        chatbot_type=chatbot_type
+    )
+    try:
+        ai_response = get_response([{'role': 'user', 'content': content}], conversation.id)
+    except Exception:
+        conversation.delete()
+        raise
+    if ai_response.startswith('Error:'):
+        conversation.delete()
+        return None, ai_response
+
+    with transaction.atomic():
+        _store_turn(conversation, content, ai_response)
+        conversation.is_visible = True
+        conversation.save(update_fields=['is_visible', 'updated_at'])
+
+    get_session(conversation.id).refresh()
+    return conversation, ai_response
@@ -0,0 +1,60 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from authentication.models import UsageHourly, UsageRecord
+
+
+class Command(BaseCommand):
+    help = "Roll raw usage records up into hourly aggregates (safe to re-run, e.g. from cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=int, default=3,
+            help='How many hours back to rebuild, including the current one (default: 3)'
+        )
+
+    def handle(self, *args, **options):
+        if options['hours'] < 1:
+            raise CommandError('--hours must be at least 1')
+
+        start = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=options['hours'] - 1)
+
+        rows = (
+            UsageRecord.objects.filter(created_at__gte=start)
+            .annotate(hour=TruncHour('created_at'))
+            .values('hour', 'user_id', 'chatbot_type', 'endpoint', 'model')
+            .annotate(
+                request_count=Count('id'),
+                prompt_total=Sum('prompt_tokens'),
+                completion_total=Sum('completion_tokens'),
+                latency_total=Sum('latency_ms'),
+            )
+            .order_by()
+        )
+
+        # Rebuilding whole hours keeps re-runs idempotent and picks up late buffered rows.
+        with transaction.atomic():
+            UsageHourly.objects.filter(hour__gte=start).delete()
+            created = UsageHourly.objects.bulk_create([
+                UsageHourly(
+                    hour=row['hour'],
+                    user_id=row['user_id'],
+                    chatbot_type=row['chatbot_type'],
+                    endpoint=row['endpoint'],
+                    model=row['model'],
+                    requests=row['request_count'],
+                    prompt_tokens=row['prompt_total'],
+                    completion_tokens=row['completion_total'],
+                    total_latency_ms=row['latency_total'],
+                )
+                for row in rows
+            ], batch_size=500)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rolled up usage since {start:%Y-%m-%d %H:00} into {len(created)} hourly rows"
+        ))
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-19 02:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0003_conversation_chatbot_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='embedding',
+            field=models.BinaryField(null=True),
+        ),
+    ]
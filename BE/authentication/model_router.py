@@ -0,0 +1,226 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import openai
+from django.conf import settings
+
+from .chat_logging import redact
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Route:
+    api_base: str
+    model: str
+
+
+class LatencyTracker:
+    """
+    Moving latency estimate (EWMA plus a window of recent samples) for one route.
+
+    Failures are counted separately rather than as latency samples, so one transient
+    error demotes a route only until its cooldown ends and it is probed again.
+    """
+
+    MIN_SAMPLES = 5
+
+    def __init__(self, window: int = 100, alpha: float = 0.2):
+        self._samples = deque(maxlen=window)
+        self._alpha = alpha
+        self._lock = threading.Lock()
+        self.ewma: Optional[float] = None
+        self.failures = 0
+        self.failed_at: Optional[float] = None
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+            self.failures = 0
+            if self.ewma is None:
+                self.ewma = seconds
+            else:
+                self.ewma = self._alpha * seconds + (1 - self._alpha) * self.ewma
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self.failed_at = time.monotonic()
+
+    def demoted(self, cooldown: float) -> bool:
+        """Whether the route failed recently enough to be tried after healthy ones."""
+        with self._lock:
+            return bool(self.failures) and time.monotonic() - self.failed_at < cooldown
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+class _Attempt:
+    """One submitted call; `started` is set once a worker thread actually runs it."""
+
+    def __init__(self, route: Route):
+        self.route = route
+        self.started = threading.Event()
+        self.started_at: Optional[float] = None
+
+    def start(self) -> float:
+        self.started_at = time.monotonic()
+        self.started.set()
+        return self.started_at
+
+
+class ModelRouter:
+    """
+    Routes completions for a chatbot type over an ordered list of (api_base, model) pairs.
+
+    The route with the lowest moving latency goes first. If it is still pending once
+    the configured latency percentile for that route has passed, a hedged duplicate is
+    sent to the next route and whichever answers first wins; the loser is cancelled if
+    it has not started yet, otherwise its result is discarded. The hedge clock starts
+    when a worker picks the call up, so time queued in the pool never triggers a hedge.
+    """
+
+    def __init__(self, routes: Dict[str, List[Route]], hedge_percentile: float = 95,
+                 default_hedge_delay: float = 2.0, min_hedge_delay: float = 0.05,
+                 max_hedges: int = 1, request_timeout: float = 60, max_workers: int = 16,
+                 failure_cooldown: float = 30):
+        self.routes = routes
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedges = max_hedges
+        self.request_timeout = request_timeout
+        self.failure_cooldown = failure_cooldown
+        self._trackers: Dict[Route, LatencyTracker] = {}
+        self._trackers_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chat-route')
+
+    def tracker(self, route: Route) -> LatencyTracker:
+        with self._trackers_lock:
+            if route not in self._trackers:
+                self._trackers[route] = LatencyTracker()
+            return self._trackers[route]
+
+    def routes_for(self, chatbot_type: str) -> List[Route]:
+        return self.routes.get(chatbot_type) or self.routes['general']
+
+    def ranked_routes(self, chatbot_type: str) -> List[Route]:
+        # Recently failed routes go last until their cooldown passes. Unmeasured routes
+        # sort first (in configured order) so every route gets sampled.
+        def key(route):
+            tracker = self.tracker(route)
+            return (tracker.demoted(self.failure_cooldown), tracker.ewma or 0.0)
+        return sorted(self.routes_for(chatbot_type), key=key)
+
+    def hedge_delay(self, route: Route) -> float:
+        threshold = self.tracker(route).percentile(self.hedge_percentile)
+        if threshold is None:
+            return self.default_hedge_delay
+        return max(threshold, self.min_hedge_delay)
+
+    def _call(self, attempt: _Attempt, params: Dict, on_complete: Optional[Callable]):
+        route = attempt.route
+        start = attempt.start()
+        try:
+            response = openai.ChatCompletion.create(
+                model=route.model,
+                api_base=route.api_base,
+                request_timeout=self.request_timeout,
+                **params
+            )
+        except Exception:
+            self.tracker(route).record_failure()
+            raise
+        latency = time.monotonic() - start
+        self.tracker(route).record(latency)
+        if on_complete is not None:
+            # Runs for hedge losers too; they still use upstream tokens.
+            try:
+                on_complete(route, response, latency)
+            except Exception as e:
+                logger.error("Completion callback failed: %s", redact(str(e)))
+        return response
+
+    def create(self, chatbot_type: str, on_complete: Optional[Callable] = None, **params):
+        ranked = self.ranked_routes(chatbot_type)
+        pending = {}
+        attempts = 0
+        hedges = 0
+        last_error = None
+
+        def launch():
+            nonlocal attempts
+            attempt = _Attempt(ranked[attempts % len(ranked)])
+            attempts += 1
+            pending[self._executor.submit(self._call, attempt, params, on_complete)] = attempt.route
+            return attempt
+
+        latest = launch()
+        while pending:
+            timeout = None
+            if hedges < self.max_hedges:
+                # Queueing in a busy pool is not upstream latency; wait for the call to start.
+                latest.started.wait()
+                deadline = latest.started_at + self.hedge_delay(latest.route)
+                timeout = max(deadline - time.monotonic(), 0)
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                hedges += 1
+                latest = launch()
+                logger.info(f"Hedging request to {latest.route.model} at {latest.route.api_base}")
+                continue
+
+            for future in done:
+                route = pending.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    logger.warning("Route %s at %s failed: %s", route.model, route.api_base, redact(str(e)))
+                    last_error = e
+                    continue
+
+                for loser in pending:
+                    loser.cancel()
+                return response
+
+            if not pending and attempts < len(ranked):
+                latest = launch()
+
+        raise last_error
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ModelRouter:
+    """Process-wide router, so latency estimates survive across requests."""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter(
+                routes={
+                    chatbot_type: [Route(api_base, model) for api_base, model in routes]
+                    for chatbot_type, routes in settings.CHAT_MODEL_ROUTES.items()
+                },
+                hedge_percentile=settings.CHAT_HEDGE_PERCENTILE,
+                default_hedge_delay=settings.CHAT_HEDGE_DEFAULT_DELAY,
+                min_hedge_delay=settings.CHAT_HEDGE_MIN_DELAY,
+                max_hedges=settings.CHAT_MAX_HEDGES,
+                request_timeout=settings.OPENAI_REQUEST_TIMEOUT,
+                max_workers=settings.CHAT_ROUTER_MAX_WORKERS,
+                failure_cooldown=settings.CHAT_ROUTE_FAILURE_COOLDOWN,
+            )
+        return _router
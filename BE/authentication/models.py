@@ -28,6 +28,59 @@ class Message(models.Model):
     role = models.CharField(max_length=50)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+    # float32 bytes from retrieval.embed(), filled lazily by the conversation index
+    embedding = models.BinaryField(null=True)
+
+    class Meta:
+        indexes = [
+            # Delta sync scans (conversation, id > cursor) ranges
+            models.Index(fields=['conversation', 'id'], name='message_conversation_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.role}: {self.content[:50]}..."
+
+class ConversationTombstone(models.Model):
+    """Records a deleted conversation so syncing clients can drop it."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    conversation_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Deleted conversation {self.conversation_id} - {self.user.username}"
+
+class UsageRecord(models.Model):
+    """One completion's token usage. Append-only; written in batches by usage.UsageBuffer."""
+    user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
+    conversation_id = models.BigIntegerField(null=True)
+    chatbot_type = models.CharField(max_length=50)
+    endpoint = models.CharField(max_length=50)
+    api_base = models.CharField(max_length=255)
+    model = models.CharField(max_length=100)
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    latency_ms = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.endpoint} {self.model}: {self.prompt_tokens}+{self.completion_tokens}"
+
+class UsageHourly(models.Model):
+    """Hourly rollup of UsageRecord, rebuilt by the rollup_usage command."""
+    hour = models.DateTimeField()
+    user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
+    chatbot_type = models.CharField(max_length=50)
+    endpoint = models.CharField(max_length=50)
+    model = models.CharField(max_length=100)
+    requests = models.PositiveIntegerField(default=0)
+    prompt_tokens = models.PositiveBigIntegerField(default=0)
+    completion_tokens = models.PositiveBigIntegerField(default=0)
+    total_latency_ms = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['hour', 'chatbot_type'], name='usage_hourly_hour_type_idx'),
+        ]
 
     def __str__(self):
-        return f"{self.role}: {self.content[:50]}..." 
\ No newline at end of file
+        return f"{self.hour:%Y-%m-%d %H:00} {self.endpoint} {self.model}: {self.requests} requests" 
\ No newline at end of file
@@ -1,7 +1,14 @@
 import openai
 from django.conf import settings
 from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import logging
+from .models import Message
+from .model_router import get_router
+from .retrieval import embed, get_conversation_index
+from .chat_logging import payload_sampled, preview, redact, summarize_messages
+from .usage import record_usage
 
 logger = logging.getLogger(__name__)
 
@@ -60,13 +67,15 @@ Important:
         }
     }
 
-    def __init__(self, chatbot_type='general'):
-        self.model = "gpt-3.5-turbo"
-        
+    def __init__(self, chatbot_type='general', user=None, endpoint=''):
         if chatbot_type not in self.CHATBOT_TYPES:
             logger.warning(f"Unknown chatbot type '{chatbot_type}', falling back to 'general'")
             chatbot_type = 'general'
         
+        self.chatbot_type = chatbot_type
+        self.user = user
+        self.endpoint = endpoint
+        self.router = get_router()
         config = self.CHATBOT_TYPES[chatbot_type]
         self.system_prompt = config['prompt']
         self.temperature = config['temperature']
@@ -74,7 +83,6 @@ Important:
         self.frequency_penalty = config['frequency_penalty']
 
         api_key = settings.OPENAI_API_KEY
-        print("Using API key:", api_key[:10] + "..." if api_key else "None")
         if not api_key:
             logger.error("OpenAI API key is not set!")
             raise ValueError("OpenAI API key is not set in environment variables")
@@ -82,12 +90,41 @@ Important:
         try:
             openai.api_base = settings.OPENAI_API_BASE
             openai.api_key = api_key
-            print(f"Using API base URL: {openai.api_base}")
         except Exception as e:
-            logger.error(f"Failed to initialize OpenAI client: {str(e)}")
+            logger.error("Failed to initialize OpenAI client: %s", redact(str(e)))
             raise
 
-    def format_messages(self, messages: List[Dict]) -> List[Dict]:
+    def select_context(self, messages: List[Dict], conversation_id: int = None) -> List[Dict]:
+        """
+        Keep the recent window plus the older messages most relevant to the latest user turn.
+
+        `messages` may be the whole conversation or just its tail, in id order; older
+        turns the caller did not pass are looked up in the conversation index.
+        """
+        window = settings.CHAT_RECENT_WINDOW
+        top_k = settings.CHAT_RETRIEVAL_TOP_K
+        # Fewer than a full window means there is nothing older to retrieve.
+        if conversation_id is None or len(messages) < window:
+            return messages
+
+        older, recent = messages[:-window], messages[-window:]
+        if 'id' not in recent[0]:
+            return messages
+
+        query = next((m['content'] for m in reversed(recent) if m['role'] == 'user'), recent[-1]['content'])
+        index = get_conversation_index(conversation_id)
+        relevant = set(index.top_k(embed(query), top_k, before_id=recent[0]['id']))
+        selected = [m for m in older if m.get('id') in relevant]
+
+        # Callers may pass only a tail of the conversation; load the rest from the table.
+        missing = relevant - {m['id'] for m in selected}
+        if missing:
+            selected.extend(Message.objects.filter(id__in=missing).values('id', 'role', 'content'))
+            selected.sort(key=lambda m: m['id'])
+        return selected + recent
+
+    def format_messages(self, messages: List[Dict], conversation_id: int = None) -> List[Dict]:
+        messages = self.select_context(messages, conversation_id)
         formatted_messages = []
         
         if not messages or messages[0]['role'] != 'system':
@@ -111,14 +148,29 @@ Important:
         
         return formatted_messages
 
-    def get_response(self, messages: List[Dict]) -> str:
+    def get_response(self, messages: List[Dict], conversation_id: int = None) -> str:
         try:
-            formatted_messages = self.format_messages(messages)
-            logger.info(f"Sending request to OpenAI with {len(formatted_messages)} messages")
-            print("Sending to OpenAI:", formatted_messages)
+            formatted_messages = self.format_messages(messages, conversation_id)
+            sampled = payload_sampled(logger)
+            logger.info("Sending request to OpenAI", extra={'fields': {
+                'chatbot_type': self.chatbot_type,
+                'messages': summarize_messages(formatted_messages)
+            }})
+            if sampled:
+                logger.debug("Sampled OpenAI request", extra={'fields': {
+                    'chatbot_type': self.chatbot_type,
+                    'messages': summarize_messages(formatted_messages, include_content=True)
+                }})
             
-            response = openai.ChatCompletion.create(
-                model=self.model,
+            response = self.router.create(
+                self.chatbot_type,
+                on_complete=partial(
+                    record_usage,
+                    user=self.user,
+                    chatbot_type=self.chatbot_type,
+                    endpoint=self.endpoint,
+                    conversation_id=conversation_id
+                ),
                 messages=formatted_messages,
                 temperature=self.temperature,
                 max_tokens=1000,
@@ -129,12 +181,48 @@ Important:
             if not response.choices:
                 raise ValueError("No response from OpenAI")
             
-            print("Got response from OpenAI:", response.choices[0].message.content)    
-            return response.choices[0].message.content
+            content = response.choices[0].message.content
+            logger.info("Got response from OpenAI", extra={'fields': {
+                'chatbot_type': self.chatbot_type,
+                'chars': len(content)
+            }})
+            if sampled:
+                logger.debug("Sampled OpenAI response", extra={'fields': {
+                    'chatbot_type': self.chatbot_type,
+                    'content': preview(content)
+                }})
+            return content
             
         except Exception as e:
-            logger.error(f"Error in OpenAI API call: {str(e)}")
-            print("OpenAI API Error:", str(e))
+            logger.error("Error in OpenAI API call: %s", redact(str(e)))
             if "api_key" in str(e).lower():
                 return "Error: OpenAI API key is invalid or not properly configured."
-            return f"Error: {str(e)}" 
\ No newline at end of file
+            return f"Error: {str(e)}"
+
+
+def _batch_item_response(item: Dict, user=None) -> Dict:
+    try:
+        chat_handler = ChatHandler(chatbot_type=item.get('chatType', 'general'), user=user, endpoint='batch_chat')
+        response = chat_handler.get_response([{'role': 'user', 'content': item['message']}])
+    except Exception as e:
+        logger.error("Batch item failed: %s", redact(str(e)))
+        return {'error': str(e)}
+
+    if response.startswith('Error:'):
+        return {'error': response}
+    return {'response': response, 'chatbot_type': chat_handler.chatbot_type}
+
+
+def get_batch_responses(items: List[Dict], max_workers: int = None, user=None) -> List[Dict]:
+    """
+    Run independent single-turn completions concurrently.
+
+    Each item is {'message': ..., 'chatType': ...}. Results come back in input
+    order, each either {'response': ..., 'chatbot_type': ...} or {'error': ...};
+    chatbot_type is the type actually used, after unknown types fall back to general.
+    """
+    if not items:
+        return []
+    max_workers = min(max_workers or settings.CHAT_BATCH_MAX_WORKERS, len(items))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chat-batch') as executor:
+        return list(executor.map(partial(_batch_item_response, user=user), items))
@@ -0,0 +1,137 @@
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+from django.conf import settings
+
+from .models import Message
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def embed(text: str, dim: int = None) -> np.ndarray:
+    """
+    Local hashed bag-of-words embedding (unigrams and bigrams), L2-normalised.
+
+    Uses crc32 rather than hash() so vectors stay stable across processes.
+    """
+    dim = dim or settings.CHAT_EMBEDDING_DIM
+    vector = np.zeros(dim, dtype=np.float32)
+    tokens = TOKEN_RE.findall(text.lower())
+    features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    if not features:
+        return vector
+
+    hashes = np.fromiter((zlib.crc32(f.encode()) for f in features), dtype=np.uint32, count=len(features))
+    signs = np.where(hashes >> 31, 1.0, -1.0).astype(np.float32)
+    np.add.at(vector, (hashes % dim).astype(np.intp), signs)
+
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+class ConversationIndex:
+    """Embedding matrix for one conversation's messages, ordered by message id."""
+
+    def __init__(self, conversation_id: int, dim: int):
+        self.conversation_id = conversation_id
+        self.dim = dim
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.last_id = 0
+        # Rows charged to the LRU budget; can lag len(ids) while a refresh is in flight
+        self.counted = 0
+        self._lock = threading.Lock()
+
+    def refresh(self) -> int:
+        """Load rows newer than the last indexed id, embedding any that are missing."""
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self) -> int:
+        rows = list(
+            Message.objects.filter(conversation_id=self.conversation_id, id__gt=self.last_id)
+            .order_by('id')
+            .values_list('id', 'content', 'embedding')
+        )
+        if not rows:
+            return 0
+
+        vectors = np.empty((len(rows), self.dim), dtype=np.float32)
+        missing = []
+        for i, (message_id, content, blob) in enumerate(rows):
+            if blob is not None and len(blob) == self.dim * 4:
+                vectors[i] = np.frombuffer(blob, dtype=np.float32)
+            else:
+                vectors[i] = embed(content, self.dim)
+                missing.append(Message(id=message_id, embedding=vectors[i].tobytes()))
+
+        if missing:
+            Message.objects.bulk_update(missing, ['embedding'], batch_size=500)
+
+        self.ids = np.concatenate([self.ids, np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))])
+        self.vectors = np.vstack([self.vectors, vectors])
+        self.last_id = int(self.ids[-1])
+        return len(rows)
+
+    def top_k(self, query: np.ndarray, k: int, before_id: Optional[int] = None) -> List[int]:
+        """
+        Ids of the k messages most cosine-similar to query, optionally only ids < before_id.
+
+        If there are no more than k candidates they are all returned, so short
+        histories are sent whole.
+        """
+        with self._lock:
+            ids, vectors = self.ids, self.vectors
+        if before_id is not None:
+            end = int(np.searchsorted(ids, before_id))
+            ids, vectors = ids[:end], vectors[:end]
+        if not len(ids) or k <= 0:
+            return []
+
+        if k >= len(ids):
+            return ids.tolist()
+
+        # Rows are unit length, so the dot product is the cosine similarity.
+        scores = vectors @ query
+        best = np.argpartition(-scores, k)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [int(ids[i]) for i in best if scores[i] > 0]
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+_cached_rows = 0
+
+
+def get_conversation_index(conversation_id: int) -> ConversationIndex:
+    """
+    Up-to-date index for a conversation, from an in-process LRU.
+
+    The LRU is bounded by the total number of indexed rows (CHAT_INDEX_CACHE_ROWS),
+    not by conversation count, since one long conversation can outweigh many short ones.
+    """
+    global _cached_rows
+    with _indexes_lock:
+        index = _indexes.pop(conversation_id, None)
+        if index is None:
+            index = ConversationIndex(conversation_id, settings.CHAT_EMBEDDING_DIM)
+        _indexes[conversation_id] = index
+
+    added = index.refresh()
+
+    with _indexes_lock:
+        # Only charge rows to an index that is still cached, and have evictions refund
+        # exactly what was charged, so a refresh racing an eviction cannot skew the total.
+        if _indexes.get(conversation_id) is index:
+            index.counted += added
+            _cached_rows += added
+        while _cached_rows > settings.CHAT_INDEX_CACHE_ROWS and len(_indexes) > 1:
+            _, evicted = _indexes.popitem(last=False)
+            _cached_rows -= evicted.counted
+    return index
@@ -0,0 +1,566 @@
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock
+
+import openai
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .chat_logging import payload_sampled, preview, summarize_messages
+from .model_router import ModelRouter, Route
+from .models import Conversation, Message, UsageHourly, UsageRecord
+from . import retrieval
+from .openai_handler import ChatHandler
+from .usage import UsageBuffer, record_usage
+
+
+class FakeUpstream:
+    """Local chat completion server; `delays` and `statuses` are consumed per request."""
+
+    def __init__(self, name, delay=0.0, delays=None, status=200, statuses=None):
+        self.name = name
+        self.delay = delay
+        self.delays = list(delays or [])
+        self.status = status
+        self.statuses = list(statuses or [])
+        self.hits = 0
+        self._lock = threading.Lock()
+
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                delay, status = upstream.next_behaviour()
+                time.sleep(delay)
+                if status == 200:
+                    body = {
+                        'id': 'chatcmpl-test',
+                        'object': 'chat.completion',
+                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': upstream.name}}],
+                        'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2},
+                    }
+                else:
+                    body = {'error': {'message': f'{upstream.name} failed', 'type': 'server_error'}}
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.route = Route(f'http://127.0.0.1:{self.server.server_address[1]}', 'test-model')
+
+    def next_behaviour(self):
+        with self._lock:
+            self.hits += 1
+            delay = self.delays.pop(0) if self.delays else self.delay
+            status = self.statuses.pop(0) if self.statuses else self.status
+        return delay, status
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ModelRouterTests(SimpleTestCase):
+    def setUp(self):
+        self._api_key = openai.api_key
+        openai.api_key = 'sk-test'
+        self.upstreams = []
+
+    def tearDown(self):
+        openai.api_key = self._api_key
+        for upstream in self.upstreams:
+            upstream.close()
+
+    def upstream(self, name, **behaviour):
+        upstream = FakeUpstream(name, **behaviour)
+        self.upstreams.append(upstream)
+        return upstream
+
+    def router(self, *upstreams, **options):
+        options.setdefault('request_timeout', 5)
+        return ModelRouter({'general': [u.route for u in upstreams]}, **options)
+
+    def complete(self, router):
+        response = router.create('general', messages=[{'role': 'user', 'content': 'hi'}])
+        return response.choices[0].message.content
+
+    def test_hedges_past_tail_latency(self):
+        primary = self.upstream('primary', delays=[1.5])
+        fallback = self.upstream('fallback', delay=0.02)
+        router = self.router(primary, fallback, default_hedge_delay=0.1)
+
+        start = time.monotonic()
+        self.assertEqual(self.complete(router), 'fallback')
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual((primary.hits, fallback.hits), (1, 1))
+
+    def test_no_hedge_while_fast(self):
+        primary = self.upstream('primary', delay=0.02)
+        fallback = self.upstream('fallback', delay=0.02)
+        router = self.router(primary, fallback, default_hedge_delay=0.5)
+
+        for _ in range(3):
+            self.complete(router)
+        self.assertEqual(primary.hits + fallback.hits, 3)
+
+    def test_queue_time_does_not_trigger_hedge(self):
+        # Both workers are busy for longer than the hedge delay, so the call spends its
+        # whole hedge budget queued; only time spent talking to the upstream counts.
+        upstream = self.upstream('only', delay=0.1)
+        router = self.router(upstream, default_hedge_delay=0.3, max_workers=2)
+        for _ in range(2):
+            router._executor.submit(time.sleep, 0.5)
+
+        self.assertEqual(self.complete(router), 'only')
+        self.assertEqual(upstream.hits, 1)
+
+    def test_fails_over_and_reprobes_after_cooldown(self):
+        primary = self.upstream('primary', statuses=[500])
+        fallback = self.upstream('fallback')
+        router = self.router(primary, fallback, failure_cooldown=0.2)
+
+        self.assertEqual(self.complete(router), 'fallback')
+        tracker = router.tracker(primary.route)
+        self.assertEqual(tracker.failures, 1)
+        self.assertIsNone(tracker.ewma)
+        self.assertEqual(router.ranked_routes('general')[0], fallback.route)
+
+        time.sleep(0.25)
+        self.assertEqual(router.ranked_routes('general')[0], primary.route)
+        self.assertEqual(self.complete(router), 'primary')
+        self.assertEqual(tracker.failures, 0)
+
+    def test_all_routes_fail(self):
+        primary = self.upstream('primary', status=500)
+        fallback = self.upstream('fallback', status=500)
+        router = self.router(primary, fallback)
+
+        with self.assertRaises(openai.error.OpenAIError):
+            self.complete(router)
+        self.assertEqual((primary.hits, fallback.hits), (1, 1))
+
+    def test_failure_logs_are_redacted(self):
+        primary = self.upstream('primary', status=500)
+        router = self.router(primary)
+
+        with self.assertLogs('authentication.model_router', level='WARNING') as logs:
+            with mock.patch('openai.ChatCompletion.create', side_effect=RuntimeError('bad key sk-abcdefghijkl for a@b.com')):
+                with self.assertRaises(RuntimeError):
+                    self.complete(router)
+        self.assertIn('[KEY]', logs.output[0])
+        self.assertNotIn('sk-abcdefghijkl', logs.output[0])
+        self.assertNotIn('a@b.com', logs.output[0])
+
+
+@override_settings(OPENAI_API_KEY='sk-test', CHAT_LOG_MAX_CHARS=12, CHAT_LOG_MAX_MESSAGES=2)
+class ChatLoggingTests(SimpleTestCase):
+    def test_preview_redacts_before_capping(self):
+        # Cut first, only '4111 111' would be left and no pattern matches a partial card
+        text = preview('pay 4111 1111 1111 1111 now')
+        self.assertEqual(text, 'pay [CARD]no...[1 more chars]')
+
+    def test_summary_caps_messages_and_chars(self):
+        messages = [{'role': 'user', 'content': f'message {i} ' + 'x' * 50} for i in range(5)]
+        summary = summarize_messages(messages, include_content=True)
+
+        self.assertEqual((summary['count'], summary['chars']), (5, sum(len(m['content']) for m in messages)))
+        self.assertEqual([m['content'][:12] for m in summary['tail']], ['message 3 xx', 'message 4 xx'])
+        self.assertTrue(all(m['content'].endswith('...[48 more chars]') for m in summary['tail']))
+
+    def get_response_logs(self):
+        reply = mock.Mock(choices=[mock.Mock(message=mock.Mock(content='reply for a@b.com'))])
+        handler = ChatHandler()
+        with self.assertLogs('authentication.openai_handler', level='DEBUG') as logs:
+            with mock.patch.object(handler.router, 'create', return_value=reply):
+                self.assertEqual(handler.get_response([{'role': 'user', 'content': 'my key is sk-abcdefghijkl'}]),
+                                 'reply for a@b.com')
+        return logs.records
+
+    @override_settings(CHAT_LOG_SAMPLE_RATE=0)
+    def test_no_content_when_not_sampled(self):
+        self.assertFalse(payload_sampled(logging.getLogger('authentication.openai_handler')))
+        records = self.get_response_logs()
+
+        self.assertEqual([r.levelno for r in records], [logging.INFO, logging.INFO])
+        self.assertNotIn('tail', records[0].fields['messages'])
+        self.assertNotIn('content', records[1].fields)
+
+    @override_settings(CHAT_LOG_SAMPLE_RATE=1)
+    def test_sampled_content_goes_to_debug_only(self):
+        records = self.get_response_logs()
+
+        info = [r for r in records if r.levelno == logging.INFO]
+        debug = [r for r in records if r.levelno == logging.DEBUG]
+        self.assertEqual((len(info), len(debug)), (2, 2))
+        self.assertNotIn('tail', info[0].fields['messages'])
+        self.assertNotIn('content', info[1].fields)
+        self.assertEqual(debug[0].fields['messages']['tail'][-1]['content'], 'my key is [K...[3 more chars]')
+        self.assertEqual(debug[1].fields['content'], 'reply for [E...[5 more chars]')
+
+
+@override_settings(OPENAI_API_KEY='sk-test')
+class SessionChatMessageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def send(self, **data):
+        return self.client.post('/api/auth/chat/message/', data, format='json')
+
+    def test_new_session_is_listed(self):
+        with mock.patch.object(ChatHandler, 'get_response', return_value='Hello!') as get_response:
+            response = self.send(message='hi', session=True, chatType='travel')
+
+        self.assertEqual(response.status_code, 200)
+        # The first turn is attributed to the new conversation
+        self.assertEqual(get_response.call_args.args[1], response.json()['conversation_id'])
+        conversations = self.client.get('/api/auth/chat/conversations/').json()
+        self.assertEqual([c['id'] for c in conversations], [response.json()['conversation_id']])
+
+        conversation = Conversation.objects.get(id=response.json()['conversation_id'])
+        self.assertEqual(conversation.chatbot_type, 'travel')
+        self.assertEqual(conversation.messages.count(), 2)
+
+    def test_failed_first_turn_leaves_no_conversation(self):
+        with mock.patch.object(ChatHandler, 'get_response', return_value='Error: upstream down'):
+            response = self.send(message='hi', session=True)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(Conversation.objects.exists())
+
+    def test_failed_turn_stores_no_messages(self):
+        with mock.patch.object(ChatHandler, 'get_response', return_value='Hello!'):
+            conversation_id = self.send(message='hi', session=True).json()['conversation_id']
+        with mock.patch.object(ChatHandler, 'get_response', return_value='Error: upstream down'):
+            response = self.send(message='again', conversationId=conversation_id)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(Conversation.objects.get(id=conversation_id).messages.count(), 2)
+
+    def test_non_integer_conversation_id_is_rejected(self):
+        for conversation_id in ({'a': 1}, [1], 'abc', 1.5, True):
+            response = self.send(message='hi', conversationId=conversation_id)
+            self.assertEqual(response.status_code, 400, conversation_id)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.conversation = Conversation.objects.create(user=self.user, title='Trip', is_visible=True)
+        Message.objects.create(conversation=self.conversation, role='user', content='hi')
+
+    def urls(self):
+        return ['/api/auth/chat/conversations/', f'/api/auth/chat/history/{self.conversation.id}/']
+
+    def test_etag_and_last_modified_return_304(self):
+        for url in self.urls():
+            first = self.client.get(url)
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified']).status_code, 304)
+
+    def test_new_message_invalidates(self):
+        etags = {url: self.client.get(url)['ETag'] for url in self.urls()}
+        Message.objects.create(conversation=self.conversation, role='assistant', content='hello')
+        for url, etag in etags.items():
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_delete_invalidates_list_last_modified(self):
+        url = '/api/auth/chat/conversations/'
+        other = Conversation.objects.create(user=self.user, title='Other', is_visible=True)
+        # Last-Modified has whole-second resolution, so age the rows past the deletion
+        hour_ago = timezone.now() - timedelta(hours=1)
+        Conversation.objects.update(updated_at=hour_ago)
+        Message.objects.update(created_at=hour_ago)
+
+        first = self.client.get(url)
+        self.assertEqual(self.client.delete(f'/api/auth/conversations/{other.id}/').status_code, 204)
+
+        second = self.client.get(url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual([c['id'] for c in second.json()], [self.conversation.id])
+        self.assertNotEqual(second['ETag'], first['ETag'])
+
+
+@override_settings(OPENAI_API_KEY='sk-test', CHAT_RECENT_WINDOW=4, CHAT_RETRIEVAL_TOP_K=2)
+class RetrievalTests(TestCase):
+    def setUp(self):
+        retrieval._indexes.clear()
+        retrieval._cached_rows = 0
+        self.user = User.objects.create_user(username='alice', password='secret')
+        self.conversation = Conversation.objects.create(user=self.user, title='Trip')
+
+    def add_messages(self, conversation, contents):
+        return [
+            Message.objects.create(conversation=conversation, role='user' if i % 2 == 0 else 'assistant', content=c)
+            for i, c in enumerate(contents)
+        ]
+
+    def test_tail_retrieves_relevant_older_turns(self):
+        older = self.add_messages(self.conversation, [
+            'my passport expires in may', 'noted', 'i love ramen', 'ramen noted',
+            'book a hotel near the station', 'hotel noted',
+        ])
+        tail = self.add_messages(self.conversation, ['ok', 'sure', 'does my passport work?', 'checking'])
+        tail = [{'id': m.id, 'role': m.role, 'content': m.content} for m in tail]
+
+        selected = ChatHandler().select_context(tail, self.conversation.id)
+
+        self.assertEqual(selected[-4:], tail)
+        self.assertIn(older[0].id, [m['id'] for m in selected[:-4]])
+        self.assertLessEqual(len(selected), 6)
+
+    def test_short_history_is_sent_whole(self):
+        messages = self.add_messages(self.conversation, ['a', 'b', 'c', 'd', 'e'])
+        messages = [{'id': m.id, 'role': m.role, 'content': m.content} for m in messages]
+
+        self.assertEqual(ChatHandler().select_context(messages, self.conversation.id), messages)
+
+    def test_send_message_passes_ordered_tail(self):
+        self.add_messages(self.conversation, [f'message {i}' for i in range(8)])
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        with mock.patch.object(ChatHandler, 'get_response', return_value='reply') as get_response:
+            response = client.post(f'/api/auth/conversations/{self.conversation.id}/send/', {'content': 'latest'}, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        passed = get_response.call_args.args[0]
+        self.assertEqual([m['content'] for m in passed], ['message 5', 'message 6', 'message 7', 'latest'])
+
+    @override_settings(CHAT_INDEX_CACHE_ROWS=5)
+    def test_index_cache_bounded_by_rows(self):
+        other = Conversation.objects.create(user=self.user, title='Other')
+        self.add_messages(self.conversation, ['one', 'two', 'three'])
+        self.add_messages(other, ['four', 'five', 'six'])
+
+        retrieval.get_conversation_index(self.conversation.id)
+        retrieval.get_conversation_index(other.id)
+
+        self.assertEqual(list(retrieval._indexes), [other.id])
+        self.assertEqual(retrieval._cached_rows, 3)
+
+    @override_settings(CHAT_INDEX_CACHE_ROWS=5)
+    def test_eviction_during_refresh_keeps_row_count(self):
+        other = Conversation.objects.create(user=self.user, title='Other')
+        self.add_messages(self.conversation, ['one', 'two', 'three'])
+        self.add_messages(other, ['four', 'five', 'six'])
+        retrieval.get_conversation_index(self.conversation.id)
+        self.add_messages(self.conversation, ['seven', 'eight'])
+
+        refresh = retrieval.ConversationIndex.refresh
+
+        def refresh_then_evict(index):
+            # Another request loads `other` and evicts this index before its rows are counted
+            added = refresh(index)
+            if index.conversation_id == self.conversation.id:
+                retrieval.get_conversation_index(other.id)
+            return added
+
+        with mock.patch.object(retrieval.ConversationIndex, 'refresh', refresh_then_evict):
+            retrieval.get_conversation_index(self.conversation.id)
+
+        self.assertEqual(list(retrieval._indexes), [other.id])
+        self.assertEqual(retrieval._cached_rows, 3)
+
+
+class SyncTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='secret')
+        other_user = User.objects.create_user(username='bob', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        self.first = Conversation.objects.create(user=self.user, title='First')
+        self.second = Conversation.objects.create(user=self.user, title='Second')
+        self.foreign = Conversation.objects.create(user=other_user, title='Bob')
+        self.ids = {conversation.id: [] for conversation in (self.first, self.second, self.foreign)}
+        for conversation in (self.first, self.foreign, self.second, self.first, self.foreign, self.first):
+            message = Message.objects.create(conversation=conversation, role='user', content='hi')
+            self.ids[conversation.id].append(message.id)
+
+    def sync(self, **data):
+        return self.client.post('/api/auth/chat/sync/', data, format='json')
+
+    @override_settings(CHAT_SYNC_PAGE_SIZE=2)
+    def test_user_cursor_pages_until_caught_up(self):
+        seen, pages, cursor = [], 0, 0
+        while True:
+            body = self.sync(cursor=cursor).json()
+            pages += 1
+            seen += [m['id'] for m in body['messages']]
+            cursor = body['cursor']
+            if not body['has_more']:
+                break
+
+        self.assertEqual(pages, 2)
+        self.assertEqual(seen, sorted(self.ids[self.first.id] + self.ids[self.second.id]))
+        self.assertEqual(cursor, seen[-1])
+        self.assertEqual(self.sync(cursor=cursor).json()['messages'], [])
+
+    def test_conversation_cursors_advance_and_ignore_foreign_ids(self):
+        first_ids = self.ids[self.first.id]
+        second_last = self.ids[self.second.id][-1]
+        body = self.sync(conversations={
+            self.first.id: first_ids[0],
+            self.second.id: second_last,
+            self.foreign.id: 0,
+        }).json()
+
+        self.assertEqual([m['id'] for m in body['messages']], first_ids[1:])
+        self.assertEqual(body['conversations'], {
+            str(self.first.id): first_ids[-1],
+            str(self.second.id): second_last,
+            str(self.foreign.id): 0,
+        })
+        self.assertFalse(body['has_more'])
+
+    def test_deletes_are_reported_as_tombstones(self):
+        self.assertEqual(self.client.delete(f'/api/auth/conversations/{self.first.id}/').status_code, 204)
+        body = self.sync().json()
+        self.assertEqual(body['deleted_conversations'], [self.first.id])
+        tombstone_cursor = body['tombstone_cursor']
+
+        self.assertEqual(self.client.post('/api/auth/chat/clear/').status_code, 200)
+        body = self.sync(tombstone_cursor=tombstone_cursor).json()
+        self.assertEqual(body['deleted_conversations'], [self.second.id])
+        self.assertGreater(body['tombstone_cursor'], tombstone_cursor)
+        self.assertEqual(body['messages'], [])
+
+        caught_up = self.sync(tombstone_cursor=body['tombstone_cursor']).json()
+        self.assertEqual(caught_up['deleted_conversations'], [])
+        self.assertEqual(caught_up['tombstone_cursor'], body['tombstone_cursor'])
+
+    def test_invalid_cursors_are_rejected(self):
+        for data in ({'cursor': 'abc'}, {'cursor': -1}, {'tombstone_cursor': 'abc'},
+                     {'conversations': [1, 2]}, {'conversations': {'x': 1}},
+                     {'conversations': {self.first.id: -1}}):
+            response = self.sync(**data)
+            self.assertEqual(response.status_code, 400, data)
+            self.assertEqual(response.json(), {'error': 'Invalid cursor'})
+
+
+@override_settings(OPENAI_API_KEY='sk-test')
+class BatchChatTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def send(self, prompts):
+        return self.client.post('/api/auth/chat/batch/', {'prompts': prompts}, format='json')
+
+    def test_reports_chatbot_type_used(self):
+        with mock.patch.object(ChatHandler, 'get_response', return_value='reply'):
+            response = self.send([
+                {'message': 'a', 'chatType': 'coding'},
+                {'message': 'b', 'chatType': 'zzz'},
+                {'chatType': 'travel'},
+            ])
+
+        results = response.json()['results']
+        self.assertEqual([r['index'] for r in results], [0, 1, 2])
+        self.assertEqual(results[0]['chatbot_type'], 'coding')
+        self.assertEqual(results[1]['chatbot_type'], 'general')
+        self.assertIn('error', results[2])
+
+    def test_runs_concurrently_in_input_order(self):
+        # Earlier prompts take longest, so completion order is the reverse of input order
+        delays = {'a': 0.3, 'b': 0.2, 'c': 0.1, 'd': 0.05}
+
+        def slow_reply(messages, conversation_id=None):
+            content = messages[-1]['content']
+            time.sleep(delays[content])
+            return f'reply {content}'
+
+        start = time.monotonic()
+        with mock.patch.object(ChatHandler, 'get_response', side_effect=slow_reply):
+            response = self.send([{'message': m} for m in delays])
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['response'] for r in response.json()['results']], [f'reply {m}' for m in delays])
+        self.assertLess(elapsed, sum(delays.values()))
+
+
+class UsageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='secret')
+        self.route = Route('http://upstream', 'test-model')
+
+    def record(self, user, chatbot_type='general', created_at=None, **usage):
+        return UsageRecord(
+            user=user, chatbot_type=chatbot_type, endpoint='chat_message', api_base=self.route.api_base,
+            model=self.route.model, prompt_tokens=usage.get('prompt', 10), completion_tokens=usage.get('completion', 5),
+            latency_ms=100, created_at=created_at or timezone.now()
+        )
+
+    def test_record_usage_reads_usage_block(self):
+        buffer = mock.Mock()
+        with mock.patch('authentication.usage.get_usage_buffer', return_value=buffer):
+            record_usage(self.route, {'usage': {'prompt_tokens': 7, 'completion_tokens': 3}}, 0.25,
+                         user=AnonymousUser(), chatbot_type='travel', endpoint='batch_chat', conversation_id=42)
+
+        record = buffer.add.call_args.args[0]
+        self.assertIsNone(record.user)
+        self.assertEqual(
+            (record.prompt_tokens, record.completion_tokens, record.latency_ms),
+            (7, 3, 250)
+        )
+        self.assertEqual(
+            (record.chatbot_type, record.endpoint, record.conversation_id, record.model),
+            ('travel', 'batch_chat', 42, 'test-model')
+        )
+
+    def test_flush_is_one_bulk_insert(self):
+        buffer = UsageBuffer(flush_size=100, flush_interval=3600)
+        for _ in range(3):
+            buffer.add(self.record(self.user))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(UsageRecord.objects.count(), 3)
+        self.assertEqual(buffer.flush(), 0)
+
+    def test_rollup_is_idempotent(self):
+        hour_ago = timezone.now() - timedelta(hours=1)
+        UsageRecord.objects.bulk_create([
+            self.record(self.user),
+            self.record(self.user, prompt=20),
+            self.record(None, chatbot_type='travel'),
+            self.record(self.user, created_at=hour_ago),
+        ])
+
+        def rollup():
+            call_command('rollup_usage', stdout=StringIO())
+            return list(UsageHourly.objects.order_by('hour', 'chatbot_type', 'user_id').values(
+                'hour', 'user_id', 'chatbot_type', 'endpoint', 'model',
+                'requests', 'prompt_tokens', 'completion_tokens', 'total_latency_ms'
+            ))
+
+        first = rollup()
+        self.assertEqual(rollup(), first)
+        self.assertEqual([(row['requests'], row['prompt_tokens']) for row in first], [(1, 10), (2, 30), (1, 10)])
+
+    def test_rollup_rejects_empty_window(self):
+        with self.assertRaises(CommandError):
+            call_command('rollup_usage', '--hours', '0', stdout=StringIO())
@@ -0,0 +1,94 @@
+import atexit
+import logging
+import threading
+from typing import List
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .chat_logging import redact
+from .models import UsageRecord
+
+logger = logging.getLogger(__name__)
+
+
+class UsageBuffer:
+    """
+    Collects UsageRecord rows in memory and writes them with one bulk insert.
+
+    A background thread writes whenever the buffer reaches `flush_size` rows or every
+    `flush_interval` seconds, and once more at exit. Callers (request and router
+    threads) only append, so no request waits on the insert.
+    """
+
+    def __init__(self, flush_size: int, flush_interval: float):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._records: List[UsageRecord] = []
+        self._lock = threading.Lock()
+        self._full = threading.Event()
+        self._flusher = None
+
+    def add(self, record: UsageRecord) -> None:
+        with self._lock:
+            self._records.append(record)
+            full = len(self._records) >= self.flush_size
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, name='usage-flush', daemon=True)
+                self._flusher.start()
+        if full:
+            self._full.set()
+
+    def flush(self) -> int:
+        with self._lock:
+            records, self._records = self._records, []
+        if not records:
+            return 0
+        try:
+            UsageRecord.objects.bulk_create(records, batch_size=500)
+        except Exception as e:
+            logger.error("Failed to write %d usage records: %s", len(records), redact(str(e)))
+            return 0
+        return len(records)
+
+    def _run(self) -> None:
+        while True:
+            self._full.wait(self.flush_interval)
+            self._full.clear()
+            try:
+                self.flush()
+            finally:
+                # This thread outlives requests, so don't hold a connection between flushes.
+                connection.close()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_usage_buffer() -> UsageBuffer:
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = UsageBuffer(settings.CHAT_USAGE_FLUSH_SIZE, settings.CHAT_USAGE_FLUSH_INTERVAL)
+            atexit.register(_buffer.flush)
+        return _buffer
+
+
+def record_usage(route, response, latency: float, user=None, chatbot_type: str = '',
+                 endpoint: str = '', conversation_id: int = None) -> None:
+    """Queue the `usage` block of a completion response for the next batched write."""
+    usage = response.get('usage') or {}
+    get_usage_buffer().add(UsageRecord(
+        user=user if user is not None and user.is_authenticated else None,
+        conversation_id=conversation_id,
+        chatbot_type=chatbot_type,
+        endpoint=endpoint,
+        api_base=route.api_base,
+        model=route.model,
+        prompt_tokens=usage.get('prompt_tokens', 0),
+        completion_tokens=usage.get('completion_tokens', 0),
+        latency_ms=int(latency * 1000),
+        created_at=timezone.now(),
+    ))
@@ -5,9 +5,35 @@ from rest_framework.permissions import IsAuthenticated, AllowAny
 from django.contrib.auth import authenticate
 from rest_framework_simplejwt.tokens import RefreshToken
 from .serializers import UserSerializer, ConversationSerializer, MessageSerializer
-from .models import Conversation, Message
-from .openai_handler import ChatHandler
+from .models import Conversation, ConversationTombstone, Message
+from .openai_handler import ChatHandler, get_batch_responses
+from .chat_sessions import run_turn, start_conversation
+from .chat_logging import redact
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _validators(prefix, *parts, last_modified=None):
+    """Build an ETag and Last-Modified timestamp from cheap aggregate values."""
+    digest = hashlib.md5(':'.join(str(part) for part in parts).encode(), usedforsecurity=False).hexdigest()
+    etag = quote_etag(f"{prefix}-{digest}")
+    # Whole seconds, like If-Modified-Since, or the comparison never matches
+    return etag, int(last_modified.timestamp()) if last_modified else None
+
+def _set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # Clients may keep a copy but must revalidate on every poll.
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
@@ -56,6 +82,11 @@ class ConversationViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            ConversationTombstone.objects.create(user=instance.user, conversation_id=instance.id)
+            instance.delete()
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def send_message(request, conversation_id):
@@ -73,11 +104,12 @@ def send_message(request, conversation_id):
             content=content
         )
 
-        messages = conversation.messages.all()
+        # Only the recent tail; ChatHandler retrieves relevant older turns from the index.
+        messages = list(conversation.messages.order_by('-id')[:settings.CHAT_RECENT_WINDOW])[::-1]
         message_list = MessageSerializer(messages, many=True).data
 
-        chat_handler = ChatHandler()
-        ai_response = chat_handler.get_response(message_list)
+        chat_handler = ChatHandler(chatbot_type=conversation.chatbot_type, user=request.user, endpoint='send_message')
+        ai_response = chat_handler.get_response(message_list, conversation_id=conversation.id)
 
         ai_message = Message.objects.create(
             conversation=conversation,
@@ -103,26 +135,23 @@ def test_chat(request):
     """Public endpoint for OpenAI chat"""
     try:
         content = request.data.get('message', '')
-        print("Received message:", content)
         if not content:
             return Response({'error': 'Message is required'}, 
                           status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            chat_handler = ChatHandler()
+            chat_handler = ChatHandler(user=request.user, endpoint='test_chat')
         except Exception as e:
-            print("Failed to initialize ChatHandler:", str(e))
+            logger.error("Failed to initialize ChatHandler: %s", redact(str(e)))
             return Response(
                 {'error': 'Failed to initialize chat service. Please try again.'}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
         messages = [{'role': 'user', 'content': content}]
-        print("Sending to OpenAI:", messages)
         
         try:
             ai_response = chat_handler.get_response(messages)
-            print("Got response from OpenAI:", ai_response)
             
             if ai_response.startswith('Error:'):
                 return Response(
@@ -137,16 +166,14 @@ def test_chat(request):
             }, status=status.HTTP_200_OK)
             
         except Exception as e:
-            print("Error getting response:", str(e))
+            logger.error("Error getting response: %s", redact(str(e)))
             return Response(
                 {'error': 'Failed to get response from chat service'}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
             
-    except Exception as e:
-        print("Unexpected error in test_chat:", str(e))
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Unexpected error in test_chat")
         return Response(
             {'error': 'An unexpected error occurred'}, 
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -159,18 +186,19 @@ def chat_message(request):
         content = request.data.get('message', '')
         chatbot_type = request.data.get('chatType', 'general')
         context = request.data.get('context', [])
-        
-        print("Received message:", content)
-        print("Context:", context)
+        conversation_id = request.data.get('conversationId')
         
         if not content:
             return Response({'error': 'Message is required'}, 
                           status=status.HTTP_400_BAD_REQUEST)
 
+        if conversation_id is not None or request.data.get('session'):
+            return _session_chat_message(request, content, chatbot_type, conversation_id)
+
         try:
-            chat_handler = ChatHandler(chatbot_type=chatbot_type)
+            chat_handler = ChatHandler(chatbot_type=chatbot_type, user=request.user, endpoint='chat_message')
         except Exception as e:
-            print("Failed to initialize ChatHandler:", str(e))
+            logger.error("Failed to initialize ChatHandler: %s", redact(str(e)))
             return Response(
                 {'error': 'Failed to initialize chat service. Please try again.'}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -195,11 +223,8 @@ def chat_message(request):
             'content': content
         })
 
-        print("Sending to OpenAI with full context:", messages)
-        
         try:
             ai_response = chat_handler.get_response(messages)
-            print("Got response from OpenAI:", ai_response)
             
             if ai_response.startswith('Error:'):
                 return Response(
@@ -215,21 +240,111 @@ def chat_message(request):
             }, status=status.HTTP_200_OK)
             
         except Exception as e:
-            print("Error getting response:", str(e))
+            logger.error("Error getting response: %s", redact(str(e)))
             return Response(
                 {'error': 'Failed to get response from chat service'}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-    except Exception as e:
-        print("Unexpected error in chat_message:", str(e))
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Unexpected error in chat_message")
         return Response(
             {'error': 'An unexpected error occurred'}, 
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def batch_chat(request):
+    """Run many independent prompts concurrently, results in request order"""
+    try:
+        prompts = request.data.get('prompts', [])
+
+        if not isinstance(prompts, list) or not prompts:
+            return Response({'error': 'A non-empty list of prompts is required'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        if len(prompts) > settings.CHAT_BATCH_MAX_SIZE:
+            return Response({'error': f'At most {settings.CHAT_BATCH_MAX_SIZE} prompts per batch'},
+                          status=status.HTTP_400_BAD_REQUEST)
+
+        items = []
+        invalid = {}
+        for index, prompt in enumerate(prompts):
+            if not isinstance(prompt, dict) or not prompt.get('message'):
+                invalid[index] = {'error': 'Message is required'}
+                continue
+            items.append({'message': prompt['message'], 'chatType': prompt.get('chatType', 'general')})
+
+        responses = iter(get_batch_responses(items, user=request.user))
+        results = []
+        for index, prompt in enumerate(prompts):
+            result = invalid.get(index) or next(responses)
+            result['index'] = index
+            results.append(result)
+
+        return Response({
+            'results': results,
+            'created_at': timezone.now()
+        }, status=status.HTTP_200_OK)
+    except Exception as e:
+        return Response({'error': str(e)}, 
+                      status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+def _session_chat_message(request, content, chatbot_type, conversation_id):
+    """
+    Server-held context mode of chat_message: the client sends only the new message
+    plus `conversationId` (or `session: true` to start one) and the server supplies
+    the history from its session cache and Message rows.
+    """
+    conversation = None
+    if conversation_id is not None:
+        try:
+            # Via str so floats, booleans and objects are rejected rather than coerced
+            conversation_id = int(str(conversation_id))
+        except ValueError:
+            return Response({'error': 'conversationId must be an integer'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        try:
+            conversation = Conversation.objects.get(id=conversation_id, user=request.user)
+        except Conversation.DoesNotExist:
+            return Response({'error': 'Conversation not found'},
+                          status=status.HTTP_404_NOT_FOUND)
+        chatbot_type = conversation.chatbot_type
+
+    try:
+        chat_handler = ChatHandler(chatbot_type=chatbot_type, user=request.user, endpoint='chat_message')
+    except Exception as e:
+        logger.error("Failed to initialize ChatHandler: %s", redact(str(e)))
+        return Response(
+            {'error': 'Failed to initialize chat service. Please try again.'},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+    if conversation is None:
+        conversation, ai_response = start_conversation(
+            request.user,
+            chat_handler.chatbot_type,
+            content[:47] + "..." if len(content) > 50 else content,
+            content,
+            chat_handler.get_response
+        )
+    else:
+        ai_response = run_turn(conversation, content, chat_handler.get_response)
+
+    if ai_response.startswith('Error:'):
+        return Response(
+            {'error': ai_response},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+    return Response({
+        'message': content,
+        'response': ai_response,
+        'created_at': timezone.now(),
+        'chatbot_type': conversation.chatbot_type,
+        'conversation_id': conversation.id
+    }, status=status.HTTP_200_OK)
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def chat_history(request):
@@ -262,6 +377,25 @@ def get_conversations(request):
             user=request.user,
             is_visible=True
         ).order_by('-updated_at')
+
+        state = conversations.aggregate(
+            count=Count('id', distinct=True),
+            updated=Max('updated_at'),
+            last_message_id=Max('messages__id'),
+            last_message_at=Max('messages__created_at'),
+        )
+        # Deletions remove rows from the aggregate, so the newest tombstone has to count too
+        deleted = ConversationTombstone.objects.filter(user=request.user).aggregate(
+            last_id=Max('id'), last_at=Max('deleted_at')
+        )
+        last_modified = max(filter(None, [state['updated'], state['last_message_at'], deleted['last_at']]), default=None)
+        etag, last_modified = _validators(
+            'conversations', request.user.id, state['count'], state['updated'], state['last_message_id'],
+            deleted['last_id'], last_modified=last_modified
+        )
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return _set_validators(not_modified, etag, last_modified)
         
         conversation_list = []
         
@@ -276,7 +410,7 @@ def get_conversations(request):
                 'timestamp': conv.updated_at
             })
         
-        return Response(conversation_list, status=status.HTTP_200_OK)
+        return _set_validators(Response(conversation_list, status=status.HTTP_200_OK), etag, last_modified)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -308,7 +442,7 @@ def save_conversation(request):
             )
 
         try:
-            chat_handler = ChatHandler()
+            chat_handler = ChatHandler(user=request.user, endpoint='save_conversation')
             conversation_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages[:3]])
             title_prompt = f"Based on this conversation, generate a short, descriptive title (max 50 chars):\n{conversation_text}"
             title = chat_handler.get_response([{'role': 'user', 'content': title_prompt}])
@@ -317,7 +451,7 @@ def save_conversation(request):
             if len(title) > 50:
                 title = title[:47] + "..."
         except Exception as e:
-            print("Error generating title:", str(e))
+            logger.warning("Error generating title: %s", redact(str(e)))
             title = messages[0]['content'][:47] + "..." if len(messages[0]['content']) > 50 else messages[0]['content']
 
         conversation.title = title
@@ -330,7 +464,7 @@ def save_conversation(request):
         }, status=status.HTTP_200_OK)
 
     except Exception as e:
-        print("Error in save_conversation:", str(e))
+        logger.error("Error in save_conversation: %s", redact(str(e)))
         return Response({
             'error': str(e),
             'status': 'error'
@@ -341,6 +475,20 @@ def save_conversation(request):
 def get_conversation_history(request, conversation_id):
     try:
         conversation = Conversation.objects.get(id=conversation_id, user=request.user)
+
+        state = conversation.messages.aggregate(
+            count=Count('id'),
+            last_id=Max('id'),
+            last_at=Max('created_at'),
+        )
+        etag, last_modified = _validators(
+            'history', conversation.id, conversation.updated_at, state['count'], state['last_id'],
+            last_modified=max(filter(None, [conversation.updated_at, state['last_at']]))
+        )
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return _set_validators(not_modified, etag, last_modified)
+
         messages = conversation.messages.all().order_by('created_at')
         
         history = []
@@ -353,7 +501,7 @@ def get_conversation_history(request, conversation_id):
                     'created_at': msg.created_at
                 })
             
-        return Response(history, status=status.HTTP_200_OK)
+        return _set_validators(Response(history, status=status.HTTP_200_OK), etag, last_modified)
     except Conversation.DoesNotExist:
         return Response({'error': 'Conversation not found'}, status=status.HTTP_404_NOT_FOUND)
     except Exception as e:
@@ -364,7 +512,93 @@ def get_conversation_history(request, conversation_id):
 def clear_history(request):
     """Delete all conversations for the user"""
     try:
-        Conversation.objects.filter(user=request.user).delete()
+        with transaction.atomic():
+            conversations = Conversation.objects.filter(user=request.user)
+            ConversationTombstone.objects.bulk_create([
+                ConversationTombstone(user=request.user, conversation_id=conversation_id)
+                for conversation_id in conversations.values_list('id', flat=True)
+            ])
+            conversations.delete()
         return Response({'message': 'Chat history cleared successfully'}, status=status.HTTP_200_OK)
     except Exception as e:
-        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR) 
\ No newline at end of file
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+def _parse_cursor(value):
+    cursor = int(value or 0)
+    if cursor < 0:
+        raise ValueError('Cursors must be non-negative')
+    return cursor
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def sync_messages(request):
+    """
+    Return messages newer than the client's cursors plus deleted-conversation tombstones.
+
+    Send either a per-user `cursor` (last seen message id across all conversations) or
+    `conversations`, a map of conversation id to last seen message id. `tombstone_cursor`
+    is the last seen tombstone id. Results are paged; keep calling while `has_more` is true.
+
+    Either way the matching rows are sorted by id before the page limit applies, so a
+    cold sync (cursor 0) sorts the user's whole history once per page; incremental
+    syncs only sort what is newer than the cursor.
+    """
+    try:
+        try:
+            tombstone_cursor = _parse_cursor(request.data.get('tombstone_cursor'))
+            per_conversation = request.data.get('conversations')
+            if per_conversation is not None:
+                cursors = {int(conv_id): _parse_cursor(last_id) for conv_id, last_id in per_conversation.items()}
+            else:
+                cursor = _parse_cursor(request.data.get('cursor'))
+        except (AttributeError, TypeError, ValueError):
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+
+        page_size = settings.CHAT_SYNC_PAGE_SIZE
+        messages = Message.objects.filter(conversation__user=request.user)
+        if per_conversation is not None:
+            if not cursors:
+                messages = messages.none()
+            else:
+                ranges = Q()
+                for conv_id, last_id in cursors.items():
+                    ranges |= Q(conversation_id=conv_id, id__gt=last_id)
+                messages = messages.filter(ranges)
+        else:
+            messages = messages.filter(id__gt=cursor)
+
+        rows = list(
+            messages.order_by('id')
+            .values('id', 'conversation_id', 'role', 'content', 'created_at')[:page_size + 1]
+        )
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+
+        tombstones = list(
+            ConversationTombstone.objects.filter(user=request.user, id__gt=tombstone_cursor)
+            .order_by('id')
+            .values_list('id', 'conversation_id')
+        )
+
+        result = {
+            'messages': [{
+                'id': row['id'],
+                'conversation': row['conversation_id'],
+                'role': row['role'],
+                'content': row['content'],
+                'created_at': row['created_at']
+            } for row in rows],
+            'deleted_conversations': [conv_id for _, conv_id in tombstones],
+            'tombstone_cursor': tombstones[-1][0] if tombstones else tombstone_cursor,
+            'has_more': has_more
+        }
+        if per_conversation is not None:
+            for row in rows:
+                cursors[row['conversation_id']] = row['id']
+            result['conversations'] = {str(conv_id): last_id for conv_id, last_id in cursors.items()}
+        else:
+            result['cursor'] = rows[-1]['id'] if rows else cursor
+
+        return Response(result, status=status.HTTP_200_OK)
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -13,6 +13,59 @@ SECRET_KEY = os.getenv('DJANGO_SECRET_KEY', 'django-insecure-default-key-change-
 DEBUG = os.getenv('DEBUG', 'True') == 'True'
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1')
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+OPENAI_REQUEST_TIMEOUT = float(os.getenv('OPENAI_REQUEST_TIMEOUT', '60'))
+
+# Ordered (api_base, model) routes per chatbot type. An optional fallback route
+# is used for failover and for hedged requests when the primary is slow.
+_chat_routes = [(OPENAI_API_BASE, OPENAI_MODEL)]
+if os.getenv('OPENAI_FALLBACK_API_BASE') or os.getenv('OPENAI_FALLBACK_MODEL'):
+    _chat_routes.append((
+        os.getenv('OPENAI_FALLBACK_API_BASE', OPENAI_API_BASE),
+        os.getenv('OPENAI_FALLBACK_MODEL', OPENAI_MODEL),
+    ))
+CHAT_MODEL_ROUTES = {
+    chatbot_type: list(_chat_routes)
+    for chatbot_type in ('general', 'travel', 'learning', 'coding')
+}
+
+# Hedging: send a duplicate once a request outlives this latency percentile
+CHAT_HEDGE_PERCENTILE = float(os.getenv('CHAT_HEDGE_PERCENTILE', '95'))
+CHAT_HEDGE_DEFAULT_DELAY = float(os.getenv('CHAT_HEDGE_DEFAULT_DELAY', '2.0'))
+CHAT_HEDGE_MIN_DELAY = float(os.getenv('CHAT_HEDGE_MIN_DELAY', '0.05'))
+CHAT_MAX_HEDGES = int(os.getenv('CHAT_MAX_HEDGES', '1'))
+# Threads making upstream calls; should cover concurrent chat requests (server
+# threads plus CHAT_BATCH_MAX_WORKERS) times (1 + CHAT_MAX_HEDGES)
+CHAT_ROUTER_MAX_WORKERS = int(os.getenv('CHAT_ROUTER_MAX_WORKERS', '64'))
+# Seconds a route that just failed is ranked after healthy ones before being re-probed
+CHAT_ROUTE_FAILURE_COOLDOWN = float(os.getenv('CHAT_ROUTE_FAILURE_COOLDOWN', '30'))
+
+# Batch completion endpoint
+CHAT_BATCH_MAX_SIZE = int(os.getenv('CHAT_BATCH_MAX_SIZE', '100'))
+CHAT_BATCH_MAX_WORKERS = int(os.getenv('CHAT_BATCH_MAX_WORKERS', '8'))
+
+# Long conversations: send the recent window plus the top-k most relevant older messages
+CHAT_RECENT_WINDOW = int(os.getenv('CHAT_RECENT_WINDOW', '10'))
+CHAT_RETRIEVAL_TOP_K = int(os.getenv('CHAT_RETRIEVAL_TOP_K', '6'))
+CHAT_EMBEDDING_DIM = 256
+# Total messages held across cached conversation indexes (~1 KB each at 256 dims)
+CHAT_INDEX_CACHE_ROWS = int(os.getenv('CHAT_INDEX_CACHE_ROWS', '100000'))
+
+# Maximum messages returned per delta-sync call
+CHAT_SYNC_PAGE_SIZE = int(os.getenv('CHAT_SYNC_PAGE_SIZE', '500'))
+
+# Server-held chat_message sessions: conversations cached, and messages kept per conversation
+CHAT_SESSION_CACHE_SIZE = int(os.getenv('CHAT_SESSION_CACHE_SIZE', '1024'))
+CHAT_SESSION_MAX_MESSAGES = int(os.getenv('CHAT_SESSION_MAX_MESSAGES', '50'))
+
+# Usage accounting: completions are buffered and inserted in batches
+CHAT_USAGE_FLUSH_SIZE = int(os.getenv('CHAT_USAGE_FLUSH_SIZE', '200'))
+CHAT_USAGE_FLUSH_INTERVAL = float(os.getenv('CHAT_USAGE_FLUSH_INTERVAL', '5'))
+
+# Chat payload logging: fraction of requests whose (redacted, capped) content is logged at DEBUG
+CHAT_LOG_SAMPLE_RATE = float(os.getenv('CHAT_LOG_SAMPLE_RATE', '0.01'))
+CHAT_LOG_MAX_CHARS = int(os.getenv('CHAT_LOG_MAX_CHARS', '200'))
+CHAT_LOG_MAX_MESSAGES = int(os.getenv('CHAT_LOG_MAX_MESSAGES', '3'))
 
 ALLOWED_HOSTS = ['*']  # Configure this properly in production
 
@@ -31,6 +84,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'django.middleware.gzip.GZipMiddleware',  # Compress large history payloads
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',  # CORS middleware
     'django.middleware.common.CommonMiddleware',
@@ -112,4 +166,22 @@ CORS_ALLOWED_ORIGINS = [
     "http://127.0.0.1:5173",
 ]
 
-CORS_ALLOW_CREDENTIALS = True 
\ No newline at end of file
+CORS_ALLOW_CREDENTIALS = True
+
+# Logging: app records go through a queue so request threads never block on stdout
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'queue': {
+            'class': 'authentication.chat_logging.QueueLogHandler',
+        },
+    },
+    'loggers': {
+        'authentication': {
+            'handlers': ['queue'],
+            'level': os.getenv('CHAT_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}